@@ -5,11 +5,13 @@ Creates a multi-valued 'year_isim' field by parsing input strings.
 import re
 import typing
 from datetime import datetime
-from dateutil import parser
+from functools import lru_cache
 
 
 
 NORMALIZED_RANGE = re.compile(r"(.*)/(.*)")
+NORMALIZED_DATE = re.compile(r"^\s*(\d{3,4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?\s*$")
+TIMESTAMP_FORMATS = ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S")
 
 def get_dates(normalized_dates: typing.Any):
     """Maps a list of 'normalized_date' strings to a sorted list of datetime.
@@ -23,38 +25,60 @@ def get_dates(normalized_dates: typing.Any):
     """
     if not isinstance(normalized_dates, typing.Iterable):
         return []
-    solr_dts = set()
+    return list(
+        _get_dates(tuple(date for date in normalized_dates if isinstance(date, str)))
+    )
+
+
+@lru_cache(maxsize=4096)
+def _get_dates(normalized_dates: typing.Tuple[str, ...]) -> typing.Tuple[datetime, ...]:
+    """Cached implementation of get_dates, keyed on a tuple of strings."""
+    if len(normalized_dates) == 1 and "/" not in normalized_dates[0]:
+        # the common single date needs no deduplication or sorting
+        solr_date = get_date(normalized_dates[0])
+        return (solr_date,) if solr_date else ()
+
+    solr_dts = []
     for normalized_date in normalized_dates:
-        if not isinstance(normalized_date, str):
-            continue
         match = NORMALIZED_RANGE.search(normalized_date)
         if match:
             start_str, end_str = match.groups()
             start = get_date(start_str)
             end = get_date(end_str)
             if start and end:
-                solr_dts.update({start, end})
+                solr_dts.extend((start, end))
         else:
             solr_date = get_date(normalized_date)
             if solr_date:
-                solr_dts.add(solr_date)
-    return sorted(solr_dts)
+                solr_dts.append(solr_date)
+    return tuple(sorted(set(solr_dts)))
 
 
-def get_date(date: str):
-    """Extracts the single 4-digit year found in the input date string.
+@lru_cache(maxsize=8192)
+def get_date(date: str) -> typing.Optional[datetime]:
+    """Parses a single date in 'normalized_date' format.
+
+    Handles YYYY, YYY, YYYY-MM and YYYY-MM-DD directly, with a fallback to a
+    few full timestamp formats. Missing months and days default to 1.
 
     Args:
         date: a string containing a date in 'normalized_date' format.
 
     Returns:
-        A single date.
+        A single date, or None if the string can't be parsed.
 
     """
-    try:
-        parsed_date = parser.parse(date, default=datetime(1978, 1, 1))
-        return parsed_date
-    except ValueError as err:
-        print(err)
-        return None
+    match = NORMALIZED_DATE.match(date)
+    if match:
+        year, month, day = match.groups()
+        try:
+            return datetime(int(year), int(month or 1), int(day or 1))
+        except ValueError:
+            return None
+    for date_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(date.strip(), date_format)
+        except ValueError:
+            continue
     return None
+
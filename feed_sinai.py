@@ -2,17 +2,25 @@
 # -*- coding: utf-8 -*-
 """Convert UCLA Library CSV files for Sinai, our Blacklight installation."""
 
+import concurrent.futures
 import csv
 from collections import defaultdict
+import functools
 import json
 import os
 import re
+import sys
 import typing
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader  # type: ignore
 
 import click
 from pysolr import Solr  # type: ignore
 import requests
+import rich.console
 import rich.progress
 
 import mapper
@@ -24,6 +32,16 @@ import date_parser
 DLCSRecord = typing.Dict[str, typing.Any]
 SinaiRecord = typing.Dict[str, typing.Any]
 
+# progress is reported on stderr, keeping stdout for JSON output
+CONSOLE = rich.console.Console(stderr=True)
+MARC_DELIMITER = "|~|"
+SESSION = requests.Session()
+SOLR_SUFFIX = re.compile(r"_[^_]+$")
+# Sinai fields used to pick a thumbnail
+THUMBNAIL_FIELDS = ("ark_ssi", "thumbnail_url_ss", "iiif_manifest_url_ssi")
+# columns of child rows used by thumbnail_from_child
+CHILD_THUMBNAIL_COLUMNS = ("Title", "Thumbnail URL", "IIIF Access URL")
+
 
 @click.command()
 @click.argument("filename")
@@ -32,45 +50,209 @@ SinaiRecord = typing.Dict[str, typing.Any]
     default=None,
     help="URL of a solr instance, e.g. http://localhost:6983/solr/californica",
 )
-def load_csv(filename: str, solr_url: typing.Optional[str]):
+@click.option(
+    "--batch_size",
+    default=500,
+    show_default=True,
+    help="Number of records to send to solr per request.",
+)
+@click.option(
+    "--max_workers",
+    default=16,
+    show_default=True,
+    help="Number of threads used to download IIIF manifests.",
+)
+def load_csv(
+    filename: str, solr_url: typing.Optional[str], batch_size: int, max_workers: int
+):
     """Load data from a csv.
 
+    Without a solr_url, records are written to stdout as a JSON array while
+    they are mapped. If a row fails to map, the command exits with an error
+    and stdout is left holding an incomplete array.
+
     Args:
         filename: A CSV file.
         solr_url: API endpoint for a solr instance.
+        batch_size: Number of records to send to solr per request.
+        max_workers: Number of threads used to download IIIF manifests.
     """
 
-    solr_client = Solr(solr_url, always_commit=True) if solr_url else Solr("")
+    solr_client = Solr(solr_url, always_commit=False) if solr_url else Solr("")
+
+    # empty cells are read as '', which map_field_value already drops, so
+    # rows are used as read with no further null handling
+    with open(filename, newline="") as csv_file:
+        reader = csv.DictReader(csv_file)
+        work_rows, collection_names, child_works = collate_rows(reader)
 
-    csv_data = { row["Item ARK"]: row for row in csv.DictReader(open(filename)) }
+    controlled_fields = load_field_config("./fields")
 
     config = {
-        "collection_names": {
-            row["Item ARK"]: row["Title"] for row in csv_data.values() if row["Object Type"] == "Collection"
-        },
-        "controlled_fields": load_field_config("./fields"),
-        "child_works": collate_child_works(csv_data),
+        "collection_names": collection_names,
+        "controlled_terms": controlled_terms(mapper.FIELD_MAPPING, controlled_fields),
+        "csv_columns": set(reader.fieldnames or []),
+        "child_works": child_works,
     }
+    config["field_plan"] = plan_fields(mapper.FIELD_MAPPING, config)
+
+    # without solr, records are streamed to stdout as a JSON array (left
+    # unterminated if a row raises); keep a handle on stdout from before
+    # rich's progress display redirects it
+    output = sys.stdout
+    if not solr_url:
+        output.write("[")
+
+    # keep one pooled connection per download thread
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        config["manifest_thumbnails"] = prefetch_manifest_thumbnails(
+            work_rows, config=config, executor=executor
+        )
 
-    controlled_fields = load_field_config("./fields")
-
+    # with manifests prefetched, mapping is CPU-bound, so rows are mapped
+    # serially and each record is handed on as soon as it is ready
     mapped_records = []
-    for row in rich.progress.track(csv_data.values(), description=f"Importing {filename}..."):
-        if row["Object Type"] not in ("ChildWork", "Page"):
-            mapped_records.append(map_record(row, solr_client, config=config))
+    for index, row in enumerate(
+        rich.progress.track(
+            work_rows, description=f"Importing {filename}...", console=CONSOLE
+        )
+    ):
+        mapped_record = map_record(row, solr_client, config=config)
+        if not solr_url:
+            output.write(", " if index else "")
+            output.write(json.dumps(mapped_record))
+            continue
+        mapped_records.append(mapped_record)
+        if len(mapped_records) >= batch_size:
+            solr_client.add(mapped_records)
+            mapped_records = []
 
     if solr_url:
-        solr_client.add(mapped_records)
+        if mapped_records:
+            solr_client.add(mapped_records)
+        solr_client.commit()
     else:
-        print(json.dumps(mapped_records))
+        output.write("]\n")
+
+def prefetch_manifest_thumbnails(
+    rows: typing.Iterable[DLCSRecord],
+    config: typing.Dict,
+    executor: concurrent.futures.Executor,
+) -> typing.Dict[str, typing.Optional[str]]:
+    """Downloads IIIF manifest thumbnails concurrently, ahead of mapping.
+
+    Only rows that have neither a thumbnail of their own nor a child row to
+    take one from will need their manifest, so the others are skipped.
 
-def collate_child_works(csv_data: csv.DictReader) -> typing.Dict:
-    # link pages to their parent works
-    child_works = defaultdict(list)
-    for row in csv_data.values():
-        if row["Object Type"] in ("ChildWork", "Page"):
-            child_works[row["Parent ARK"]].append(row)
-    return child_works
+    Args:
+        rows: CSV rows that will be mapped.
+        config: A config object, as passed to thumbnail_from_child.
+        executor: Executor used to download the manifests.
+
+    Returns:
+        A dict mapping manifest URLs to thumbnail URLs (or None).
+    """
+    field_plan = config.get("field_plan") or plan_fields(mapper.FIELD_MAPPING, config)
+    thumbnail_plan = [
+        (field_name, map_value)
+        for field_name, map_value in field_plan
+        if field_name in THUMBNAIL_FIELDS
+    ]
+    manifest_urls = set()
+    for row in rows:
+        record = {field_name: map_value(row) for field_name, map_value in thumbnail_plan}
+        if thumbnail_without_manifest(record, config=config):
+            continue
+        manifest_url = record.get("iiif_manifest_url_ssi")
+        if isinstance(manifest_url, str) and manifest_url:
+            manifest_urls.add(manifest_url)
+
+    urls = sorted(manifest_urls)
+    thumbnails = executor.map(
+        lambda url: thumbnail_from_manifest({"iiif_manifest_url_ssi": url}), urls
+    )
+    manifest_thumbnails: typing.Dict[str, typing.Optional[str]] = {}
+    # the tracked iterator comes first, so zip resumes it after the last
+    # item and the progress bar reaches 100%
+    for thumbnail, url in zip(
+        rich.progress.track(
+            thumbnails,
+            total=len(urls),
+            description="Downloading IIIF manifests...",
+            console=CONSOLE,
+        ),
+        urls,
+    ):
+        manifest_thumbnails[url] = thumbnail
+    return manifest_thumbnails
+
+
+def thumbnail_without_manifest(
+    record: SinaiRecord, config: typing.Dict
+) -> typing.Optional[str]:
+    """Picks a thumbnail from the record itself or its child rows.
+
+    These are the thumbnail sources that map_record tries before falling
+    back to the IIIF manifest.
+
+    Args:
+        record: A mapping with at least the THUMBNAIL_FIELDS of a Sinai record.
+        config: A config object.
+
+    Returns:
+        A string containing the thumbnail URL, or None.
+    """
+    return record.get("thumbnail_url_ss") or thumbnail_from_child(record, config=config)
+
+
+def collate_rows(
+    rows: typing.Iterable[DLCSRecord],
+) -> typing.Tuple[typing.List[DLCSRecord], typing.Dict[str, str], typing.Dict]:
+    """Sorts CSV rows by object type in a single pass.
+
+    Child rows are only used to pick thumbnails, so only the columns needed
+    for that are kept; the rest of each page row is dropped as it is read.
+    Rows to map are deduplicated by Item ARK, the last occurrence winning.
+
+    Args:
+        rows: CSV rows, e.g. a csv.DictReader.
+
+    Returns:
+        A tuple of (rows to map, collection titles keyed by ARK, child rows
+        keyed by parent ARK in order of preference as thumbnails).
+    """
+    work_rows: typing.Dict[str, DLCSRecord] = {}
+    collection_names: typing.Dict[str, str] = {}
+    child_works: typing.Dict[str, typing.List[DLCSRecord]] = defaultdict(list)
+    for row in rows:
+        object_type = row["Object Type"]
+        if object_type in ("ChildWork", "Page"):
+            child_works[row["Parent ARK"]].append(
+                {column: row.get(column) for column in CHILD_THUMBNAIL_COLUMNS}
+            )
+            continue
+        if object_type == "Collection":
+            collection_names[row["Item ARK"]] = row["Title"]
+        work_rows[row["Item ARK"]] = row
+    for children in child_works.values():
+        children.sort(key=thumbnail_sort_key)
+    return list(work_rows.values()), collection_names, child_works
+
+
+def collate_child_works(csv_data: typing.Dict[str, DLCSRecord]) -> typing.Dict:
+    # link pages to their parent works, in order of preference as thumbnails
+    return collate_rows(csv_data.values())[2]
+
+
+def thumbnail_sort_key(row: DLCSRecord) -> str:
+    """Sort key that prefers child rows titled like "f. 001r", in alphanumeric order."""
+    title = row["Title"] or ""
+    if title.startswith("f. "):
+        return "a" + title
+    return "z" + title
 
 
 def load_field_config(base_path: str = "./fields") -> typing.Dict:
@@ -86,22 +268,106 @@ def load_field_config(base_path: str = "./fields") -> typing.Dict:
     for path, _, files in os.walk(base_path):
         for file_name in files:
             field_name = os.path.splitext(file_name)[0]
-            with open(os.path.join(path, file_name), "r") as stream:
-                field_config[field_name] = yaml.safe_load(stream)
+            with open(os.path.join(path, file_name), "rb") as stream:
+                field_config[field_name] = yaml.load(stream, Loader=SafeLoader)
             field_config[field_name]["terms"] = {
                 t["id"]: t["term"] for t in field_config[field_name]["terms"]
             }
     return field_config
 
 
+def controlled_terms(
+    field_names: typing.Iterable[str], field_config: typing.Dict
+) -> typing.Dict[str, typing.Dict[str, str]]:
+    """Looks up the controlled vocabulary, if any, for each Sinai field.
+
+    Args:
+        field_names: Names of Sinai/Solr fields, e.g. the keys of FIELD_MAPPING.
+        field_config: Controlled field configuration from load_field_config().
+
+    Returns:
+        A dict mapping each controlled field name to its dict of terms.
+    """
+    terms: typing.Dict[str, typing.Dict[str, str]] = {}
+    for field_name in field_names:
+        bare_field_name = get_bare_field_name(field_name)
+        if bare_field_name in field_config:
+            terms[field_name] = field_config[bare_field_name]["terms"]
+    return terms
+
+
 def map_field_value(
     row: DLCSRecord, field_name: str, config: typing.Dict
 ) -> typing.Any:
     """Map value from a CSV cell to an object that will be passed to solr.
 
+    See plan_fields() for how FIELD_MAPPING[field_name] is interpreted.
+
+    Args:
+        row: An input row containing a DLCS record.
+        field_name: The name of the Sinai/Solr field to map.
+        config: A config object.
+
+    Returns:
+        A value to be submitted to solr. By default this is a list of strings,
+        however map_[SOLR_FIELD_NAME] functions can return other types.
+    """
+    [(_, map_value)] = plan_fields(
+        {field_name: mapper.FIELD_MAPPING[field_name]}, config=config
+    )
+    return map_value(row)
+
+
+def map_columns(
+    row: DLCSRecord,
+    columns: typing.Iterable[str],
+    terms: typing.Optional[typing.Dict[str, str]],
+) -> typing.List[str]:
+    """Maps one or more CSV columns to a list of strings.
+
+    Args:
+        row: An input row containing a DLCS record.
+        columns: Names of the CSV columns to map.
+        terms: Controlled vocabulary for the field, if any.
+
+    Returns:
+        The '|~|'-separated values of all columns, translated by terms.
+    """
+    output: typing.List[str] = []
+    for csv_field in columns:
+        input_value = row.get(csv_field)
+        if not input_value:
+            continue
+        if not isinstance(input_value, str):
+            output.append(terms.get(input_value, input_value) if terms else input_value)
+            continue
+        # remove untruthy values like '' while splitting
+        values = filter(None, input_value.split(MARC_DELIMITER))
+        if terms:
+            output.extend(terms.get(value, value) for value in values)
+        else:
+            output.extend(values)
+
+    return output
+
+
+def map_nothing(_row: DLCSRecord) -> None:
+    """Mapping for fields that FIELD_MAPPING maps to None."""
+    return None
+
+
+# (field name, function mapping a CSV row to the field's value), in FIELD_MAPPING order
+FieldPlan = typing.List[typing.Tuple[str, typing.Callable[[DLCSRecord], typing.Any]]]
+
+
+def plan_fields(field_mapping: mapper.MappingDict, config: typing.Dict) -> FieldPlan:
+    """Resolves a field mapping to one mapping function per field.
+
     Mapping logic is defined by the FIELD_MAPPING dict, defined in mappery.py.
     Keys of FIELD_MAPPING are output field names as used in Sinai. Values can
-    vary, and the behavior of map_field_value() will depend on that value.
+    vary, and the behavior of the resulting function will depend on that value.
+
+    If FIELD_MAPPING[field_name] is None, the field is mapped to None.
 
     If FIELD_MAPPING[field_name] is a string, then it will be interpreted as
     the title of a CSV column to map. The value of that column will be split
@@ -118,51 +384,52 @@ def map_field_value(
     type that matches the type of the solr field. This is the only way to
     map to types other than lists of strings.
 
+    All of this is decided once per field, so map_record only calls the
+    resulting functions. If config["csv_columns"] is set, column mappings
+    are narrowed to the columns in that set: FIELD_MAPPING lists every name a
+    column has been exported under, most of which are absent from any one
+    CSV. Controlled terms come from config["controlled_terms"].
+
     Args:
-        row: An input row containing a DLCS record.
-        field_name: The name of the Sinai/Solr field to map.
+        field_mapping: A mapping of Sinai field names, like FIELD_MAPPING.
+        config: A config object.
 
     Returns:
-        A value to be submitted to solr. By default this is a list of strings,
-        however map_[SOLR_FIELD_NAME] functions can return other types.
+        A FieldPlan.
     """
-    mapping: mapper.MappigDictValue = mapper.FIELD_MAPPING[field_name]
-
-    if mapping is None:
-        return None
-
-    if callable(mapping):
-        return mapping(row)
-
-    if isinstance(mapping, str):
-        mapping = [mapping]
-
-    if not isinstance(mapping, typing.Collection):
-        raise TypeError(
-            f"FIELD_MAPPING[field_name] must be iterable, unless it is None, Callable, or a string."
+    csv_columns = config.get("csv_columns")
+    plan: FieldPlan = []
+    for field_name, mapping in field_mapping.items():
+        if mapping is None:
+            plan.append((field_name, map_nothing))
+            continue
+
+        if callable(mapping):
+            plan.append((field_name, mapping))
+            continue
+
+        if isinstance(mapping, str):
+            mapping = [mapping]
+
+        if not isinstance(mapping, typing.Collection):
+            raise TypeError(
+                f"FIELD_MAPPING[field_name] must be iterable, unless it is None, Callable, or a string."
+            )
+
+        columns = tuple(
+            column for column in mapping if csv_columns is None or column in csv_columns
         )
-
-    output: typing.List[str] = []
-    for csv_field in mapping:
-        input_value = row.get(csv_field)
-        if input_value:
-            if isinstance(input_value, str):
-                output.extend(input_value.split("|~|"))
-            else:
-                output.append(input_value)
-
-    bare_field_name = get_bare_field_name(field_name)
-    if bare_field_name in config.get("controlled_fields", {}):
-        terms = config["controlled_fields"][bare_field_name]["terms"]
-        output = [terms.get(value, value) for value in output]
-
-    return [value for value in output if value]  # remove untruthy values like ''
+        terms = config.get("controlled_terms", {}).get(field_name)
+        plan.append(
+            (field_name, functools.partial(map_columns, columns=columns, terms=terms))
+        )
+    return plan
 
 
 def get_bare_field_name(field_name: str) -> str:
     """Strips the solr suffix and initial 'human_readable_' from a field name."""
 
-    return re.sub(r"_[^_]+$", "", field_name).replace("human_readable_", "")
+    return SOLR_SUFFIX.sub("", field_name).replace("human_readable_", "")
 
 def solr_transformed_dates(solr_client: Solr, parsed_dates: typing.List):
     """ the dates  in sorted list are transformed to solr format  """
@@ -178,17 +445,19 @@ def map_record(row: DLCSRecord, solr_client: Solr, config: typing.Dict) -> Sinai
         A mapping representing the record to submit to Solr.
 
     """
-    record: SinaiRecord = {
-        field_name: map_field_value(row, field_name, config=config)
-        for field_name in mapper.FIELD_MAPPING
-    }
+    field_plan = config.get("field_plan") or plan_fields(mapper.FIELD_MAPPING, config)
+    record: SinaiRecord = {field_name: map_value(row) for field_name, map_value in field_plan}
 
     # THUMBNAIL
-    record["thumbnail_url_ss"] = (
-        record.get("thumbnail_url_ss")
-        or thumbnail_from_child(record, config=config)
-        or thumbnail_from_manifest(record)
-    )
+    thumbnail = thumbnail_without_manifest(record, config=config)
+    if not thumbnail:
+        manifest_url = record.get("iiif_manifest_url_ssi")
+        manifest_thumbnails = config.get("manifest_thumbnails", {})
+        if manifest_url in manifest_thumbnails:
+            thumbnail = manifest_thumbnails[manifest_url]
+        else:
+            thumbnail = thumbnail_from_manifest(record)
+    record["thumbnail_url_ss"] = thumbnail
 
     # COLLECTION NAME
     if "Parent ARK" in row and row["Parent ARK"] in config["collection_names"]:
@@ -356,28 +625,34 @@ def thumbnail_from_child(
         return None
 
     ark = record["ark_ssi"]
-    children: list = config["child_works"][ark]
-
-    def sort_key(row: dict) -> str:
-        if row["Title"].startswith("f. "):
-            return "a" + row["Title"]  # prefer records of this form, in alphanumeric sort order
-        else:
-            return "z" + row["Title"]
-        
-    children.sort(key=sort_key)
+    children: list = config["child_works"].get(ark, [])
 
     for row in children:
         thumb = mapper.thumbnail_url(row)
         if thumb:
-            print(row["Title"])
             return thumb
 
     return None
 
 
+def fetch_manifest(manifest_url: str) -> typing.Any:
+    """Downloads and parses a IIIF manifest.
+
+    Args:
+        manifest_url: URL of a IIIF manifest.
+
+    Returns:
+        The parsed JSON manifest.
+    """
+    return SESSION.get(manifest_url, timeout=10).json()
+
+
 def thumbnail_from_manifest(record: SinaiRecord) -> typing.Optional[str]:
     """Picks a thumbnail downloading the IIIF manifest.
 
+    Uses the canvas labeled "f. 001r", stopping as soon as it is found, or
+    otherwise the first canvas.
+
     Args:
         record: A mapping representing the CSV record.
 
@@ -389,18 +664,20 @@ def thumbnail_from_manifest(record: SinaiRecord) -> typing.Optional[str]:
         manifest_url = record.get("iiif_manifest_url_ssi")
         if not isinstance(manifest_url, str):
             return None
-        response = requests.get(manifest_url)
-        manifest = response.json()
-
-        canvases = {
-            c["label"]: c["images"][0]["resource"]["service"]["@id"]
-            for seq in manifest["sequences"]
-            for c in seq["canvases"]
-        }
-
-        return (
-            canvases.get("f. 001r") or list(canvases.values())[0]
-        ) + "/full/!200,200/0/default.jpg"
+        manifest = fetch_manifest(manifest_url)
+
+        image_url = None
+        for seq in manifest["sequences"]:
+            for canvas in seq["canvases"]:
+                if image_url is None:
+                    image_url = canvas["images"][0]["resource"]["service"]["@id"]
+                if canvas["label"] == "f. 001r":
+                    image_url = canvas["images"][0]["resource"]["service"]["@id"]
+                    return image_url + "/full/!200,200/0/default.jpg"
+
+        if image_url is None:
+            return None
+        return image_url + "/full/!200,200/0/default.jpg"
 
     except:  # pylint: disable=bare-except
         return None
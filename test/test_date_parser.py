@@ -75,3 +75,22 @@ def test_duplicates():
         datetime.datetime(1934, 6, 1),
         datetime.datetime(1935, 7, 1)
     ]
+
+def test_timestamp():
+    """Parses full timestamps."""
+
+    assert date_parser.get_dates(["1941-10-01T12:30:00Z"]) == [
+        datetime.datetime(1941, 10, 1, 12, 30)
+    ]
+
+def test_invalid_month():
+    """Doesn't return anything for dates that don't exist."""
+
+    assert date_parser.get_dates(["1941-13-01"]) == []
+
+def test_cached_results_are_copies():
+    """Repeated inputs are served from the cache without sharing the output list."""
+
+    first = date_parser.get_dates(["1953"])
+    first.append(datetime.datetime(2000, 1, 1))
+    assert date_parser.get_dates(["1953"]) == [datetime.datetime(1953, 1, 1)]
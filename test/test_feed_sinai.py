@@ -2,17 +2,87 @@
 # pylint: disable=no-self-use
 
 import csv
+import io
+import json
+import os
 
+from click.testing import CliRunner
 import pytest  # type: ignore
 from pysolr import Solr  # type: ignore
 import feed_sinai
 import test.fixtures as fixtures  # pylint: disable=wrong-import-order
 
 
-@pytest.mark.xfail()
-def test_load_csv():
-    """test for function load_csv"""
-    raise NotImplementedError
+class TestLoadCsv:
+    """tests for function load_csv"""
+
+    COLUMNS = [
+        "Item ARK", "Parent ARK", "Object Type", "Title", "Thumbnail URL", "IIIF Manifest URL"
+    ]
+
+    @pytest.fixture
+    def csv_file(self, tmp_path):
+        """A CSV with one collection, four works and a page."""
+        rows = [
+            ["ark:/collection/1", "", "Collection", "Test Collection", "/c.jpg", ""],
+            ["ark:/work/1", "ark:/collection/1", "Work", "Work 1", "/w1.jpg", ""],
+            ["ark:/work/2", "ark:/collection/1", "Work", "Work 2", "/w2.jpg", ""],
+            ["ark:/work/3", "ark:/collection/1", "Work", "Work 3", "/w3.jpg", ""],
+            ["ark:/work/4", "ark:/collection/1", "Work", "Work 4", "", ""],
+            ["ark:/page/1", "ark:/work/4", "Page", "f. 001r", "/p1.jpg", ""],
+        ]
+        path = tmp_path / "test.csv"
+        with open(path, "w", newline="") as stream:
+            writer = csv.writer(stream)
+            writer.writerow(self.COLUMNS)
+            writer.writerows(rows)
+        return str(path)
+
+    def test_prints_json(self, csv_file, monkeypatch):
+        """without --solr_url, writes the mapped records to stdout as a JSON array"""
+        monkeypatch.setattr(
+            feed_sinai, "CONSOLE", feed_sinai.rich.console.Console(file=io.StringIO())
+        )
+        result = CliRunner().invoke(feed_sinai.load_csv, [csv_file])
+
+        assert result.exit_code == 0, result.output
+        records = json.loads(result.output)
+        assert [record["id"] for record in records] == [
+            "ark:/collection/1",
+            "ark:/work/1",
+            "ark:/work/2",
+            "ark:/work/3",
+            "ark:/work/4",
+        ]
+        assert records[4]["thumbnail_url_ss"] == "/p1.jpg"
+        assert records[1]["member_of_collections_ssim"] == ["Test Collection"]
+
+    def test_batches_solr_adds(self, csv_file, monkeypatch):
+        """sends records to solr in batches of --batch_size, then commits once"""
+        calls = []
+
+        class StubSolr(Solr):
+            """Records calls instead of talking to solr"""
+
+            def add(self, docs, *args, **kwargs):  # pylint: disable=arguments-differ
+                calls.append(("add", [doc["id"] for doc in docs]))
+
+            def commit(self, *args, **kwargs):  # pylint: disable=arguments-differ
+                calls.append(("commit",))
+
+        monkeypatch.setattr(feed_sinai, "Solr", StubSolr)
+        result = CliRunner().invoke(
+            feed_sinai.load_csv,
+            [csv_file, "--solr_url", "http://localhost:6983/solr/sinai", "--batch_size", "2"],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert calls == [
+            ("add", ["ark:/collection/1", "ark:/work/1"]),
+            ("add", ["ark:/work/2", "ark:/work/3"]),
+            ("add", ["ark:/work/4"]),
+            ("commit",),
+        ]
 
 
 class TestMapFieldValue:
@@ -34,6 +104,18 @@ class TestMapFieldValue:
             "three",
         ]
 
+    def test_drops_empty_values(self, monkeypatch):
+        """drops empty strings left over from splitting on '|~|'"""
+
+        monkeypatch.setitem(
+            feed_sinai.mapper.FIELD_MAPPING, "test_sinai_field_tesim", "Test DLCS Field"
+        )
+        input_record = {"Test DLCS Field": "one|~||~|two|~|"}
+        result = feed_sinai.map_field_value(
+            input_record, "test_sinai_field_tesim", config={}
+        )
+        assert result == ["one", "two"]
+
     def test_calls_function(self, monkeypatch):
         """If mapper defines a function map_[SOLR_NAME], calls that function."""
         # pylint: disable=no-member
@@ -46,6 +128,81 @@ class TestMapFieldValue:
         assert result == "lkghsdh"
 
 
+    def test_translates_controlled_terms(self, monkeypatch):
+        """Replaces controlled term ids with their human-readable terms"""
+
+        monkeypatch.setitem(
+            feed_sinai.mapper.FIELD_MAPPING, "language_tesim", "Language"
+        )
+        config = {"controlled_terms": {"language_tesim": {"ara": "Arabic"}}}
+        result = feed_sinai.map_field_value(
+            {"Language": "ara|~|unknown"}, "language_tesim", config=config
+        )
+        assert result == ["Arabic", "unknown"]
+
+
+def test_load_field_config():
+    """function load_field_config"""
+
+    fields_path = os.path.join(os.path.dirname(__file__), "..", "fields")
+    field_config = feed_sinai.load_field_config(fields_path)
+    assert field_config["language"]["terms"]["ara"] == "Arabic"
+
+
+def test_controlled_terms():
+    """function controlled_terms"""
+
+    field_config = {"language": {"terms": {"ara": "Arabic"}}}
+    assert feed_sinai.controlled_terms(
+        ["human_readable_language_tesim", "title_tesim"], field_config
+    ) == {"human_readable_language_tesim": {"ara": "Arabic"}}
+
+
+class TestPlanFields:
+    """tests for function plan_fields"""
+
+    FIELD_MAPPING = {
+        "none_tesim": None,
+        "id": lambda row: row["Item ARK"],
+        "title_tesim": "Title",
+        "language_tesim": ["Language", "Language.other"],
+    }
+    ROW = {
+        "Item ARK": "ark:/123/abc",
+        "Title": "one|~|two",
+        "Language": "ara",
+        "Language.other": "eng",
+    }
+
+    def test_maps_each_kind_of_field(self):
+        """returns one mapping function per field, in FIELD_MAPPING order"""
+
+        config = {"controlled_terms": {"language_tesim": {"ara": "Arabic"}}}
+        plan = feed_sinai.plan_fields(self.FIELD_MAPPING, config)
+
+        assert [field_name for field_name, _ in plan] == list(self.FIELD_MAPPING)
+        assert {field_name: map_value(self.ROW) for field_name, map_value in plan} == {
+            "none_tesim": None,
+            "id": "ark:/123/abc",
+            "title_tesim": ["one", "two"],
+            "language_tesim": ["Arabic", "eng"],
+        }
+
+    def test_narrows_to_csv_columns(self):
+        """only reads columns present in config["csv_columns"]"""
+
+        config = {"csv_columns": {"Item ARK", "Title", "Language"}}
+        plan = dict(feed_sinai.plan_fields(self.FIELD_MAPPING, config))
+
+        assert plan["language_tesim"](self.ROW) == ["ara"]
+
+    def test_rejects_bad_mapping(self):
+        """raises TypeError for mappings that aren't None, callable, or strings"""
+
+        with pytest.raises(TypeError):
+            feed_sinai.plan_fields({"bad_tesim": 1}, {})
+
+
 def test_get_bare_field_name():
     """function get_bare_field_name"""
 
@@ -146,6 +303,16 @@ class TestMapRecord:
             == "https://test.iiif.server/url/full/!200,200/0/default.jpg"
         )
 
+    def test_uses_prefetched_manifest_thumbnail(self):
+        """uses the thumbnail downloaded by prefetch_manifest_thumbnails"""
+        manifest_url = "https://iiif.library.ucla.edu/ark%3A%2F123%2Fabc/manifest"
+        result = feed_sinai.map_record(
+            {"Item ARK": "ark:/123/abc", "IIIF Manifest URL": manifest_url},
+            self.solr_client,
+            config={**self.CONFIG, "manifest_thumbnails": {manifest_url: "/thumb.jpg"}},
+        )
+        assert result["thumbnail_url_ss"] == "/thumb.jpg"
+
     def test_sets_access(self):
         """sets permissive values for blacklight-access-control"""
         result = feed_sinai.map_record(
@@ -216,6 +383,37 @@ class TestMapRecord:
         assert result[facet_field_name] == [value]
 
 
+def test_collate_rows():
+    """function collate_rows"""
+
+    work_rows, collection_names, child_works = feed_sinai.collate_rows([
+        {
+            "Object Type": "Collection",
+            "Item ARK": "ark:/collection/1",
+            "Parent ARK": None,
+            "Title": "Test Collection",
+        },
+        {
+            "Object Type": "Work",
+            "Item ARK": "ark:/work/1",
+            "Parent ARK": "ark:/collection/1",
+            "Title": None,
+        },
+        {
+            "Object Type": "Page",
+            "Item ARK": "ark:/child/1",
+            "Parent ARK": "ark:/work/1",
+            "Title": "f. 001r",
+        },
+    ])
+
+    assert [row["Item ARK"] for row in work_rows] == ["ark:/collection/1", "ark:/work/1"]
+    assert collection_names == {"ark:/collection/1": "Test Collection"}
+    assert child_works["ark:/work/1"] == [
+        {"Title": "f. 001r", "Thumbnail URL": None, "IIIF Access URL": None}
+    ]
+
+
 class TestThumbnailFromChild:
     """Tests for feed_sinai.thumbnail_from_child."""
 
@@ -319,6 +517,39 @@ class TestThumbnailFromChild:
         assert result is None
 
 
+def test_prefetch_manifest_thumbnails(monkeypatch):
+    """Downloads manifests only for rows without another thumbnail source"""
+    urls = []
+
+    def get(url, **kwargs):
+        urls.append(url)
+        return fixtures.GOOD_MANIFEST
+
+    monkeypatch.setattr(feed_sinai.SESSION, "get", get)
+    rows = [
+        {"Item ARK": "ark:/work/1", "IIIF Manifest URL": "http://manifest/1"},
+        {
+            "Item ARK": "ark:/work/2",
+            "IIIF Manifest URL": "http://manifest/2",
+            "Thumbnail URL": "/thumb2.jpg",
+        },
+        {"Item ARK": "ark:/work/3", "IIIF Manifest URL": "http://manifest/3"},
+    ]
+    config = {
+        "child_works": {"ark:/work/3": [{"Title": "f. 001r", "Thumbnail URL": "/thumb3.jpg"}]}
+    }
+
+    with feed_sinai.concurrent.futures.ThreadPoolExecutor() as executor:
+        result = feed_sinai.prefetch_manifest_thumbnails(
+            rows, config=config, executor=executor
+        )
+
+    assert urls == ["http://manifest/1"]
+    assert result == {
+        "http://manifest/1": "https://iiif.sinaimanuscripts.library.ucla.edu/iiif/2/ark%3A%2F21198%2Fz14b44n8%2Fzw07hs0c/full/!200,200/0/default.jpg"  # pylint: disable=line-too-long
+    }
+
+
 class TestThumbnailFromManifest:
     """Function thumbnail_from_manifest"""
 
@@ -327,7 +558,7 @@ class TestThumbnailFromManifest:
     def test_picks_folio_1r(self, monkeypatch):
         "uses the page titled 'f. 001r', if found"
         monkeypatch.setattr(
-            feed_sinai.requests, "get", lambda x: fixtures.GOOD_MANIFEST
+            feed_sinai.SESSION, "get", lambda url, **kwargs: fixtures.GOOD_MANIFEST
         )
 
         result = feed_sinai.thumbnail_from_manifest(self.record)
@@ -339,7 +570,7 @@ class TestThumbnailFromManifest:
     def test_picks_first_page(self, monkeypatch):
         "uses the first image if 'f. 001r' is not found"
         monkeypatch.setattr(
-            feed_sinai.requests, "get", lambda x: fixtures.MANIFEST_WITHOUT_F001R
+            feed_sinai.SESSION, "get", lambda url, **kwargs: fixtures.MANIFEST_WITHOUT_F001R
         )
 
         result = feed_sinai.thumbnail_from_manifest(self.record)
@@ -352,7 +583,7 @@ class TestThumbnailFromManifest:
         "returns None if HTTP request fails"
 
         monkeypatch.setattr(
-            feed_sinai.requests, "get", lambda x: fixtures.MockResponse(None, 404)
+            feed_sinai.SESSION, "get", lambda url, **kwargs: fixtures.MockResponse(None, 404)
         )
 
         result = feed_sinai.thumbnail_from_manifest(self.record)
@@ -362,7 +593,7 @@ class TestThumbnailFromManifest:
         "returns None if manifest contains no images"
 
         monkeypatch.setattr(
-            feed_sinai.requests, "get", lambda x: fixtures.MANIFEST_WITHOUT_IMAGES
+            feed_sinai.SESSION, "get", lambda url, **kwargs: fixtures.MANIFEST_WITHOUT_IMAGES
         )
 
         result = feed_sinai.thumbnail_from_manifest(self.record)
@@ -371,7 +602,9 @@ class TestThumbnailFromManifest:
     def test_bad_data(self, monkeypatch):
         "returns None if manifest isn't parsable"
 
-        monkeypatch.setattr(feed_sinai.requests, "get", lambda x: fixtures.BAD_MANIFEST)
+        monkeypatch.setattr(
+            feed_sinai.SESSION, "get", lambda url, **kwargs: fixtures.BAD_MANIFEST
+        )
 
         result = feed_sinai.thumbnail_from_manifest(self.record)
         assert result is None
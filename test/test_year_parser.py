@@ -87,3 +87,11 @@ def test_duplicates():
         1934,
         1935,
     ]
+
+
+def test_cached_results_are_copies():
+    """Repeated inputs are served from the cache without sharing the output list."""
+
+    first = year_parser.integer_years(["1953/1954"])
+    first.append(2000)
+    assert year_parser.integer_years(["1953/1954"]) == [1953, 1954]
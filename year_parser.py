@@ -4,6 +4,7 @@ Creates a multi-valued 'year_isim' field by parsing input strings.
 
 import re
 import typing
+from functools import lru_cache
 
 
 RANGE = re.compile(r"(.*)/(.*)")
@@ -21,11 +22,14 @@ def integer_years(dates: typing.Any) -> typing.List[int]:
     """
     if not isinstance(dates, typing.Iterable):
         return []
+    return list(_integer_years(tuple(date for date in dates if isinstance(date, str))))
 
+
+@lru_cache(maxsize=4096)
+def _integer_years(dates: typing.Tuple[str, ...]) -> typing.Tuple[int, ...]:
+    """Cached implementation of integer_years, keyed on a tuple of strings."""
     years: typing.Set[int] = set()
     for date in dates:
-        if not isinstance(date, str):
-            continue
         match = RANGE.search(date)
         if match:
             start_str, end_str = match.groups()
@@ -37,9 +41,10 @@ def integer_years(dates: typing.Any) -> typing.List[int]:
             year = get_year(date)
             if year:
                 years.add(year)
-    return sorted(years)
+    return tuple(sorted(years))
 
 
+@lru_cache(maxsize=8192)
 def get_year(date: str) -> typing.Optional[int]:
     """Extracts the single 4-digit year found in the input date string.
 